@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+"""
+    pearson
+    ~~~~~~~
+
+    Sphinx builder producing LaTeX output formatted to be delivered to
+    Pearson for print production, one ``.tex`` file per chapter.
+
+    Much of this code is adapted from sphinx.builders.latex.
+
+    :copyright: Copyright 2007-2016 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from os import path
+
+from six import text_type
+
+from docutils import nodes
+from docutils.io import StringOutput
+from docutils.utils import new_document
+from docutils.frontend import OptionParser
+
+import jinja2
+
+from sphinx import addnodes
+from sphinx import highlighting
+from sphinx.builders import Builder
+from sphinx.environment import NoUri
+from sphinx.locale import _
+from sphinx.theming import Theme
+from sphinx.util import texescape
+from sphinx.util.console import bold, darkgreen
+from sphinx.util.nodes import inline_all_toctrees
+from sphinx.util.parallel import ParallelTasks, parallel_available
+from sphinx.util.osutil import SEP, copyfile, ensuredir
+
+from pearson import writer
+
+#: Name of the file, relative to the output directory, remembering what
+#: was written on the previous build so unchanged inputs can be skipped.
+CACHE_FILENAME = '.pearson_cache.json'
+
+#: Whether texescape.init() has run in this process; its translation
+#: tables only need to be built once, not per builder instance.
+_TEXESCAPE_INITIALIZED = False
+
+#: Cache key remembering the chapter/appendix list that book.tex was
+#: last rendered from. A '!' prefix keeps it out of the docname space.
+_EXTERNAL_DOCS_KEY = '!external_docs'
+
+#: Comment header for the generated pygments.sty, built once at import
+#: time instead of being re-dedented on every build.
+_PYGMENTS_HEADER = '''\
+%% Generated by the Pearson Sphinx extension.
+%% Style: {}
+'''
+
+
+def _copy_one(paths):
+    """Copy one file into the output directory.
+
+    Hard-links instead of copying when source and destination are on
+    the same filesystem, falling back to a byte copy when they are not.
+    """
+    src, dest = paths
+    if path.exists(dest):
+        try:
+            os.unlink(dest)
+        except OSError:
+            pass
+    try:
+        os.link(src, dest)
+    except OSError:
+        copyfile(src, dest)
+
+
+def _needs_copy(entry, dst):
+    """Return True if the scandir entry should be copied to dst.
+
+    The DirEntry already carries its stat result, so a fresh
+    destination only costs one stat call to detect.
+    """
+    return (not path.exists(dst) or
+            os.stat(dst).st_mtime < entry.stat().st_mtime)
+
+
+def _write_if_changed(file_name, body):
+    """Write body to file_name, unless the file already has that content.
+
+    Returns the hash digest of the new content so callers can remember
+    what was written.
+    """
+    if isinstance(body, text_type):
+        body = body.encode('utf-8')
+    new_digest = hashlib.blake2b(body).hexdigest()
+    try:
+        with open(file_name, 'rb') as f:
+            old_digest = hashlib.blake2b(f.read()).hexdigest()
+    except (IOError, OSError):
+        old_digest = None
+    if new_digest != old_digest:
+        with open(file_name, 'wb') as f:
+            f.write(body)
+    return new_digest
+
+
+class PearsonLaTeXBuilder(Builder):
+    """
+    Builds LaTeX output broken into one file per chapter.
+    """
+    name = 'pearson'
+    format = 'latex'
+    supported_image_types = ['application/pdf', 'image/png', 'image/jpeg']
+    usepackages = []
+
+    # Set by the theme to replace the default translator.
+    translator_class = None
+
+    theme = None
+
+    def init(self):
+        self.docnames = []
+        self.document_data = []
+        self._template_cache = {}
+        self._pygments_bridges = {}
+        self._doctree_cache = {}
+        self._image_cache = {}
+
+    def get_theme_config(self):
+        return self.config.pearson_theme, self.config.pearson_theme_options
+
+    _templates = None
+
+    @property
+    def templates(self):
+        # Loading the theme and building the template bridge is only
+        # needed when output is actually written, not for the dependency
+        # queries some callers make, so defer it to first use.
+        if self._templates is None:
+            self.init_templates()
+        return self._templates
+
+    @templates.setter
+    def templates(self, bridge):
+        self._templates = bridge
+
+    def init_templates(self):
+        if self.theme is not None:
+            # Already initialized; do not rebuild the template bridge
+            # and throw away the compiled templates.
+            return
+        Theme.init_themes(self.confdir, self.config.pearson_theme_path,
+                          warn=self.warn)
+        themename, themeoptions = self.get_theme_config()
+        self.theme = Theme(themename, warn=self.warn)
+        self.theme_options = themeoptions.copy()
+        self.create_template_bridge()
+        self.templates.init(self, self.theme)
+        if hasattr(self.templates, 'environment'):
+            env = self.templates.environment
+            # The templates never change out from under a build, so do
+            # not pay for the modification-time check on each render.
+            env.auto_reload = False
+            # Persist the compiled templates across build processes so
+            # a fresh process loads them without re-parsing the source.
+            cache_dir = path.join(self.outdir, '.jinja_cache')
+            ensuredir(cache_dir)
+            env.bytecode_cache = jinja2.FileSystemBytecodeCache(
+                directory=cache_dir,
+                pattern='%s.cache',
+            )
+
+    def get_outdated_docs(self):
+        return 'all documents'  # for now
+
+    def get_target_uri(self, docname, typ=None):
+        if docname not in self.docnames:
+            raise NoUri
+        else:
+            return '%' + docname
+
+    def get_relative_uri(self, from_, to, typ=None):
+        # ignore source path
+        return self.get_target_uri(to, typ)
+
+    def init_document_data(self):
+        preliminary_document_data = [
+            list(x) for x in self.config.pearson_documents
+        ]
+        if not preliminary_document_data:
+            self.warn('no "pearson_documents" config value found; '
+                      'no documents will be written')
+            return
+        # assign subdirs to titles
+        self.titles = []
+        for entry in preliminary_document_data:
+            docname = entry[0]
+            if docname not in self.env.all_docs:
+                self.warn('"pearson_documents" config value references unknown '
+                          'document %s' % docname)
+                continue
+            self.document_data.append(entry)
+            if docname.endswith(SEP + 'index'):
+                docname = docname[:-5]
+            self.titles.append((docname, entry[2]))
+        # Sorted copies of the title list so assemble_doctree can find
+        # the chapter owning a referenced document by binary search
+        # instead of scanning every chapter for every cross-reference.
+        self._sorted_titles = sorted(self.titles)
+        self._title_keys = [subdir for subdir, _ in self._sorted_titles]
+
+    def _load_cache(self):
+        cache_file = path.join(self.outdir, CACHE_FILENAME)
+        try:
+            with open(cache_file, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_cache(self, cache):
+        cache_file = path.join(self.outdir, CACHE_FILENAME)
+        with open(cache_file, 'w') as f:
+            # json.dump would issue many small writes; serialize first
+            # so the file is written in one call.
+            f.write(json.dumps(cache))
+
+    def _input_mtime(self, docname):
+        """Return the newest mtime among the sources feeding docname.
+
+        Follows the toctree to the other documents spliced into the
+        chapter, and the recorded dependencies of each. Returns None if
+        any input cannot be examined, which forces a rebuild.
+        """
+        latest = 0.0
+        seen = set()
+        pending = [docname]
+        while pending:
+            dn = pending.pop()
+            if dn in seen:
+                continue
+            seen.add(dn)
+            pending.extend(self.env.toctree_includes.get(dn, ()))
+            filenames = [self.env.doc2path(dn)]
+            filenames.extend(path.join(self.srcdir, dep)
+                             for dep in self.env.dependencies.get(dn, ()))
+            for filename in filenames:
+                try:
+                    latest = max(latest, path.getmtime(filename))
+                except OSError:
+                    return None
+        return latest
+
+    def _render_template(self, template_name, file_name, context):
+        if hasattr(self.templates, 'environment'):
+            # Compile each template once per builder instead of going
+            # through the bridge's name lookup on every render.
+            tmpl = self._template_cache.get(template_name)
+            if tmpl is None:
+                tmpl = self.templates.environment.get_template(template_name)
+                self._template_cache[template_name] = tmpl
+            # Stream the render straight into the file so the full body
+            # is never held in memory; blocks are written as the
+            # template produces them.
+            with open(file_name, 'w', encoding='utf-8',
+                      buffering=65536) as f:
+                tmpl.stream(context).dump(f)
+        else:
+            body = self.templates.render(template_name, context)
+            _write_if_changed(file_name, body)
+
+    def _write_pygments_stylesheet(self):
+        key = (self.config.pygments_style, self.config.trim_doctest_flags)
+        highlighter = self._pygments_bridges.get(key)
+        if highlighter is None:
+            highlighter = highlighting.PygmentsBridge('latex', *key)
+            self._pygments_bridges[key] = highlighter
+        stylesheet = path.join(self.outdir, 'pygments.sty')
+        self.info('writing {}'.format(stylesheet))
+        body = _PYGMENTS_HEADER.format(self.config.pygments_style)
+        body += highlighter.get_stylesheet()
+        _write_if_changed(stylesheet, body)
+
+    def _get_doctree(self, docname):
+        """Return the doctree for docname, unpickling it at most once per
+        build.
+
+        The index document of each chapter is read several times while
+        the chapter is written; going back to disk for each read is
+        wasted work. inline_all_toctrees copies the tree it is given, so
+        handing out the cached instance is safe.
+        """
+        tree = self._doctree_cache.get(docname)
+        if tree is None:
+            tree = self.env.get_doctree(docname)
+            self._doctree_cache[docname] = tree
+        return tree
+
+    def _scan_index(self, indexfile):
+        """Collect the toctree details for a chapter in a single pass.
+
+        Returns (contentsname, tocdepth, has_toctree): the caption of
+        the first captioned toctree, the maxdepth of the first toctree,
+        and whether the document has any toctrees at all, walking the
+        doctree only once instead of once per value.
+        """
+        contentsname = None
+        tocdepth = None
+        has_toctree = False
+        for toctree in self._get_doctree(indexfile).traverse(addnodes.toctree):
+            if not has_toctree:
+                if toctree.get('maxdepth') > 0:
+                    tocdepth = toctree.get('maxdepth')
+                has_toctree = True
+            if contentsname is None and 'caption' in toctree and \
+                    toctree['caption']:
+                contentsname = toctree['caption']
+        return contentsname, tocdepth, has_toctree
+
+    def post_process_images(self, doctree):
+        """Pick the best candidate for each image URI.
+
+        Overridden from Builder to remember the winning candidate per
+        URI; an image reused across chapters (a logo, a shared diagram)
+        only pays for the candidate search in the first chapter that
+        references it.
+        """
+        for node in doctree.traverse(nodes.image):
+            original = node['uri']
+            candidate = self._image_cache.get(original)
+            if candidate is None:
+                if '?' in node['candidates']:
+                    # don't rewrite nonlocal image URIs
+                    continue
+                if '*' not in node['candidates']:
+                    for imgtype in self.supported_image_types:
+                        candidate = node['candidates'].get(imgtype, None)
+                        if candidate:
+                            break
+                    else:
+                        self.warn(
+                            'no matching candidate for image URI %r' %
+                            original,
+                            '%s:%s' % (node.source, getattr(node, 'line', '')),
+                        )
+                        continue
+                else:
+                    candidate = original
+                self._image_cache[original] = candidate
+            node['uri'] = candidate
+            if candidate in self.env.images:
+                self.images[candidate] = self.env.images[candidate][1]
+
+    def write(self, *ignored):
+        # Deferred from init() so builder instantiation stays cheap for
+        # callers that never write anything, and guarded so multiple
+        # builders in one process build the tables only once.
+        global _TEXESCAPE_INITIALIZED
+        if not _TEXESCAPE_INITIALIZED:
+            texescape.init()
+            _TEXESCAPE_INITIALIZED = True
+
+        docwriter = writer.PearsonLaTeXWriter(self)
+        docsettings = OptionParser(
+            defaults=self.env.settings,
+            components=(docwriter,),
+            read_config_files=True,
+        ).get_default_values()
+
+        self.init_document_data()
+
+        cache = self._load_cache()
+
+        global_context = {}
+
+        def process_doc(name, docname):
+            out_file = path.join(self.outdir, name + '.tex')
+            # Skip chapters whose inputs have not changed since the
+            # last build and whose output is still in place.
+            mtime = self._input_mtime(docname)
+            cached = cache.get(docname)
+            if (mtime is not None and cached and
+                    cached[0] == mtime and path.exists(out_file)):
+                self.info('{} is up to date as {}'.format(docname, name))
+                return name
+            self.info('processing {} as {}'.format(docname, name))
+            contentsname, tocdepth, has_toctree = self._scan_index(docname)
+            doctree = self.assemble_doctree(docname, False, appendices=[],
+                                            has_toctree=has_toctree)
+            doctree['tocdepth'] = tocdepth
+            self.post_process_images(doctree)
+            doctree.settings = docsettings
+            doctree.settings.contentsname = contentsname
+            doctree.settings.docname = docname
+            self.info('writing...', nonl=1)
+            destination = StringOutput(encoding='utf-8')
+            docwriter.write(doctree, destination)
+            output_hash = _write_if_changed(out_file, docwriter.output)
+            cache[docname] = (mtime, output_hash)
+            self.info('done')
+            return name
+
+        # The chapters are independent of each other, so they can be
+        # written by forked workers. The output names are deterministic,
+        # which lets the parent record them in order at submission time;
+        # only the cache entries need to come back from the children.
+        nproc = self.config.pearson_parallel
+        tasks = None
+        if nproc > 1 and parallel_available:
+            tasks = ParallelTasks(nproc)
+
+        def process_doc_task(args):
+            name, docname = args
+            process_doc(name, docname)
+            return (docname, cache.get(docname))
+
+        def on_doc_done(args, result):
+            docname, entry = result
+            if entry is not None:
+                cache[docname] = entry
+
+        # All of the output names are known before any chapter is
+        # processed, so compute them in one pass up front rather than
+        # formatting inside the loop.
+        width = 3 if len(self.document_data) >= 100 else 2
+        chap_names = ['chap{:0{}d}'.format(num, width)
+                      for num in range(1, len(self.document_data) + 1)]
+        global_context['chapter_names'] = chap_names
+
+        appendices = self.config.pearson_appendices
+        width = 3 if len(appendices) >= 100 else 2
+        app_names = ['app{:0{}d}'.format(num, width)
+                     for num in range(1, len(appendices) + 1)]
+        global_context['appendix_names'] = app_names
+
+        doc_pairs = list(zip(chap_names,
+                             (entry[0] for entry in self.document_data)))
+        doc_pairs.extend(zip(app_names, appendices))
+
+        for name, docname in doc_pairs:
+            if tasks is not None:
+                tasks.add_task(process_doc_task, (name, docname),
+                               on_doc_done)
+            else:
+                process_doc(name, docname)
+
+        if tasks is not None:
+            tasks.join()
+
+        self.info('writing front matter')
+        self._render_template(
+            'half-title.tex',
+            path.join(self.outdir, 'half-title.tex'),
+            global_context,
+        )
+        self._render_template(
+            'title.tex',
+            path.join(self.outdir, 'title.tex'),
+            global_context,
+        )
+
+        external_docs = (global_context['chapter_names'] +
+                         global_context['appendix_names'])
+        # The only dynamic content in book.tex is the list of chapter
+        # and appendix files, so when the list matches the previous
+        # build the render can be skipped entirely, not just the write.
+        if (cache.get(_EXTERNAL_DOCS_KEY) != external_docs or
+                not path.exists(path.join(self.outdir, 'book.tex'))):
+            self.info('writing book.tex')
+            self._render_template(
+                'book.tex',
+                path.join(self.outdir, 'book.tex'),
+                dict(global_context, external_docs=external_docs),
+            )
+            cache[_EXTERNAL_DOCS_KEY] = external_docs
+        else:
+            self.info('book.tex is up to date')
+
+        self._write_pygments_stylesheet()
+
+        self._save_cache(cache)
+        # Release the memory held by the unpickled doctrees.
+        self._doctree_cache.clear()
+
+    def assemble_doctree(self, indexfile, toctree_only, appendices,
+                         has_toctree=None):
+        self.docnames = {indexfile, *appendices}
+        self.info(darkgreen(indexfile) + " ", nonl=1)
+        tree = self._get_doctree(indexfile)
+        tree['docname'] = indexfile
+        if toctree_only:
+            # extract toctree nodes from the tree and put them in a
+            # fresh document
+            new_tree = new_document('<pearson output>')
+            new_sect = nodes.section()
+            new_sect += nodes.title(u'<Set title in conf.py>',
+                                    u'<Set title in conf.py>')
+            new_tree += new_sect
+            for node in tree.traverse(addnodes.toctree):
+                new_sect += node
+            tree = new_tree
+        if has_toctree is None:
+            has_toctree = bool(tree.traverse(addnodes.toctree))
+        if has_toctree:
+            largetree = inline_all_toctrees(self, self.docnames, indexfile,
+                                            tree, darkgreen, [indexfile])
+        else:
+            # A leaf chapter with nothing to splice in; there is no
+            # point walking the toctree graph just to copy the tree.
+            largetree = tree
+        largetree['docname'] = indexfile
+        for docname in appendices:
+            appendix = self._get_doctree(docname)
+            appendix['docname'] = docname
+            largetree.append(appendix)
+        self.info()
+        self.info("resolving references...")
+        self.env.resolve_references(largetree, indexfile, self)
+        # resolve :ref:s to distant tex files -- we can't add a
+        # cross-reference, but append the document name
+        for pendingnode in largetree.traverse(addnodes.pending_xref):
+            docname = pendingnode['refdocname']
+            sectname = pendingnode['refsectname']
+            newnodes = [nodes.emphasis(sectname, sectname)]
+            i = bisect.bisect_right(self._title_keys, docname) - 1
+            if i >= 0 and docname.startswith(self._title_keys[i]):
+                title = self._sorted_titles[i][1]
+                newnodes.append(nodes.Text(_(' (in '), _(' (in ')))
+                newnodes.append(nodes.emphasis(title, title))
+                newnodes.append(nodes.Text(')', ')'))
+            pendingnode.replace_self(newnodes)
+        return largetree
+
+    def finish(self):
+        pending = []
+
+        # copy image files
+        if self.images:
+            self.info(bold('copying images...'), nonl=1)
+            for src, dest in self.images.items():
+                self.info(' ' + src, nonl=1)
+                pending.append((path.join(self.srcdir, src),
+                                path.join(self.outdir, dest)))
+            self.info()
+
+        # copy additional files
+        if self.config.latex_additional_files:
+            self.info(bold('copying additional files...'), nonl=1)
+            for filename in self.config.latex_additional_files:
+                self.info(' ' + filename, nonl=1)
+                pending.append((path.join(self.confdir, filename),
+                                path.join(self.outdir,
+                                          path.basename(filename))))
+            self.info()
+
+        # copy theme static files
+        themestaticdirname = path.join(self.theme.themedir, 'static')
+        if path.isdir(themestaticdirname):
+            self.info(bold('copying theme files...'), nonl=1)
+            for entry in os.scandir(themestaticdirname):
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                dst = path.join(self.outdir, entry.name)
+                if not _needs_copy(entry, dst):
+                    continue
+                self.info(' ' + entry.name, nonl=1)
+                pending.append((entry.path, dst))
+            self.info()
+
+        if pending:
+            # The copies are independent and I/O-bound, so overlap them
+            # instead of paying per-file syscall latency serially.
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                list(ex.map(_copy_one, pending))
+
+        self.info('done')
+
+
+def setup(app):
+    app.add_builder(PearsonLaTeXBuilder)
+    app.add_config_value('pearson_documents',
+                         lambda self: self.latex_documents, 'env')
+    app.add_config_value('pearson_appendices', [], 'env')
+    app.add_config_value('pearson_parallel', 1, '')
+    app.add_config_value('pearson_theme', 'pearson', 'env')
+    app.add_config_value('pearson_theme_path', [], 'env')
+    app.add_config_value('pearson_theme_options', {}, 'env')
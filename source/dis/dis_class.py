@@ -16,4 +16,5 @@ class MyObject:
         self.name = name
 
 
-dis.dis(MyObject)
+if __name__ == '__main__':
+    dis.dis(MyObject)